@@ -16,10 +16,17 @@ import os
 import sys
 import json
 import shutil
-import re
-from collections import defaultdict
-import random
-import math
+import bisect
+import errno
+import functools
+import concurrent.futures
+import concurrent.futures.process
+from collections import deque
+
+try:
+    import orjson  # Optional: faster JSON serialization
+except ImportError:
+    orjson = None
 
 # Configuration
 PRELIMINARY_DB_PATH = (
@@ -29,45 +36,148 @@ TARGET_DB_PATH = "molecule-game-web/data/DB"  # Target directory for selected mo
 JSON_OUTPUT_PATH = "molecule-game-web/data/molecules.json"  # JSON dataset for the game
 NUM_MOLECULES = 120  # Number of target molecules to select
 SIMILARITY_THRESHOLD = 0.2  # Maximum difference in atom count (as a percentage) for similar molecules
+MOLECULE_CACHE_PATH = ".mol_cache.json"  # Cache of parsed molecule data, reused across runs
+MOLECULE_CACHE_VERSION = 1  # Bump whenever parse_mol2_file changes the data it produces
+PARALLEL_PARSE_MIN_FILES = 200  # Below this many files, parse serially to avoid process pool startup cost
+
+@functools.lru_cache(maxsize=None)
+def _parse_mol2_file_cached(file_path, file_name, mtime, size):
+    """
+    Parse a .mol2 file, caching the result for the lifetime of the process.
+    mtime and size are only part of the cache key, so a modified file is reparsed.
+    The cache is per process: when collect_molecule_data parses in a process pool,
+    results cached in the workers are not visible to the parent.
+    """
+    name = None
+    atom_count = 0
+    header_parsed = False
+    atoms_parsed = False
+    c_atoms = o_atoms = n_atoms = h_atoms = 0
+    
+    # Single pass over the file: the MOLECULE header gives the name and
+    # atom count, the ATOM section gives the SYBYL atom types. Lines are
+    # scanned as bytes and only the molecule name is decoded.
+    state = None
+    with open(file_path, 'rb') as f:
+        for line in f:
+            if line.startswith(b'@<TRIPOS>'):
+                if state == 'ATOM':
+                    atoms_parsed = True
+                section = line.strip()
+                if section == b'@<TRIPOS>MOLECULE':
+                    state = 'MOL_HEADER'
+                elif section == b'@<TRIPOS>ATOM':
+                    state = 'ATOM'
+                else:
+                    state = None
+                if header_parsed and atoms_parsed:
+                    break
+                continue
+            
+            if state == 'MOL_HEADER':
+                parts = line.split()
+                if not parts:
+                    continue
+                if name is None:
+                    name = parts[0].decode()
+                else:
+                    # First field of the counts line is the number of atoms
+                    if parts[0].isdigit():
+                        atom_count = int(parts[0])
+                    header_parsed = True
+                    state = None
+            elif state == 'ATOM':
+                # Only the first six fields are needed; the sixth is the SYBYL atom type
+                parts = line.split(None, 6)
+                if len(parts) < 6:
+                    continue
+                atom_type = parts[5]
+                if atom_type.startswith(b'C.'):
+                    c_atoms += 1
+                elif atom_type.startswith(b'O.'):
+                    o_atoms += 1
+                elif atom_type.startswith(b'N.'):
+                    n_atoms += 1
+                elif atom_type == b'H':
+                    h_atoms += 1
+    
+    if name is None:
+        name = file_name.replace('.mol2', '')
+    
+    return {
+        'file_path': file_path,
+        'name': name,
+        'atom_count': atom_count,
+        'c_atoms': c_atoms,
+        'o_atoms': o_atoms,
+        'n_atoms': n_atoms,
+        'h_atoms': h_atoms,
+        'file_name': file_name
+    }
 
-def parse_mol2_file(file_path):
+def parse_mol2_file(file_path, file_name=None, mtime=None, size=None):
     """
     Parse a .mol2 file and extract relevant information.
     Returns a dictionary with molecule information.
+    
+    Args:
+        file_path: Path to the .mol2 file
+        file_name: Base name of the file, if already known (avoids recomputing it)
+        mtime: Modification time of the file in nanoseconds, if already known
+        size: Size of the file in bytes, if already known
     """
+    if file_name is None:
+        file_name = os.path.basename(file_path)
+    
     try:
-        with open(file_path, 'r') as f:
-            content = f.read()
-            
-        # Extract molecule name
-        name_match = re.search(r'@<TRIPOS>MOLECULE\s+(\S+)', content)
-        name = name_match.group(1) if name_match else os.path.basename(file_path).replace('.mol2', '')
-        
-        # Extract atom count
-        atom_count_match = re.search(r'@<TRIPOS>MOLECULE\s+\S+\s+(\d+)', content)
-        atom_count = int(atom_count_match.group(1)) if atom_count_match else 0
-        
-        # Count specific atom types
-        c_atoms = len(re.findall(r'\s+C\.\d+\s+', content))
-        o_atoms = len(re.findall(r'\s+O\.\d+\s+', content))
-        n_atoms = len(re.findall(r'\s+N\.\d+\s+', content))
-        h_atoms = len(re.findall(r'\s+H\s+', content))
-        
-        return {
-            'file_path': file_path,
-            'name': name,
-            'atom_count': atom_count,
-            'c_atoms': c_atoms,
-            'o_atoms': o_atoms,
-            'n_atoms': n_atoms,
-            'h_atoms': h_atoms,
-            'file_name': os.path.basename(file_path)
-        }
+        if mtime is None or size is None:
+            stat = os.stat(file_path)
+            mtime, size = stat.st_mtime_ns, stat.st_size
+        molecule_data = _parse_mol2_file_cached(file_path, file_name, mtime, size)
     except Exception as e:
         print(f"Error parsing {file_path}: {str(e)}")
         return None
+    
+    # Return a copy so callers cannot modify the cached result
+    return dict(molecule_data)
+
+def load_molecule_cache(cache_path):
+    """
+    Load previously parsed molecule data from the cache file.
+    Returns a tuple (manifest, molecules) where manifest maps file paths to
+    [mtime, size] and molecules maps file paths to parsed molecule data
+    (None for files that could not be parsed).
+    A cache written with a different MOLECULE_CACHE_VERSION is ignored.
+    """
+    if not cache_path or not os.path.exists(cache_path):
+        return {}, {}
+    
+    try:
+        with open(cache_path, 'r') as f:
+            cache = json.load(f)
+        if not isinstance(cache, dict) or cache.get('version') != MOLECULE_CACHE_VERSION:
+            print(f"Ignoring outdated molecule cache '{cache_path}'.")
+            return {}, {}
+        return cache['manifest'], cache['molecules']
+    except Exception as e:
+        print(f"Ignoring unreadable molecule cache '{cache_path}': {str(e)}")
+        return {}, {}
 
-def collect_molecule_data(db_path, min_atoms=5):
+def save_molecule_cache(cache_path, manifest, molecules):
+    """
+    Save parsed molecule data to the cache file.
+    """
+    try:
+        with open(cache_path, 'w') as f:
+            json.dump({
+                'version': MOLECULE_CACHE_VERSION,
+                'manifest': manifest,
+                'molecules': molecules
+            }, f)
+    except Exception as e:
+        print(f"Error saving molecule cache '{cache_path}': {str(e)}")
+
+def collect_molecule_data(db_path, min_atoms=5, cache_path=MOLECULE_CACHE_PATH):
     """
     Collect information about all molecules in the database.
     Returns a list of molecule data dictionaries.
@@ -75,6 +185,7 @@ def collect_molecule_data(db_path, min_atoms=5):
     Args:
         db_path: Path to the directory containing .mol2 files
         min_atoms: Minimum number of atoms required (default: 5)
+        cache_path: File used to cache parsed molecule data between runs (None disables it)
     """
     molecules = []
     
@@ -82,17 +193,70 @@ def collect_molecule_data(db_path, min_atoms=5):
         print(f"Error: The directory '{db_path}' does not exist.")
         return molecules
     
-    mol2_files = [f for f in os.listdir(db_path) if f.endswith('.mol2')]
+    with os.scandir(db_path) as it:
+        entries = [e for e in it if e.name.endswith('.mol2')]
     
-    if not mol2_files:
+    if not entries:
         print(f"Error: No .mol2 files found in '{db_path}'.")
         return molecules
     
-    print(f"Found {len(mol2_files)} .mol2 files in '{db_path}'.")
+    print(f"Found {len(entries)} .mol2 files in '{db_path}'.")
+    
+    # Record modification time and size, skipping files that cannot be read
+    # (e.g. dangling symlinks or files removed since the directory was listed)
+    paths = []
+    names = {}
+    manifest = {}
+    for entry in entries:
+        try:
+            stat = entry.stat()
+        except OSError as e:
+            print(f"Error parsing {entry.path}: {str(e)}")
+            continue
+        paths.append(entry.path)
+        names[entry.path] = entry.name
+        manifest[entry.path] = [stat.st_mtime_ns, stat.st_size]  # A list, to compare equal to the JSON cache
+    
+    # Reuse cached data for files whose modification time and size are unchanged
+    cached_manifest, cached_molecules = load_molecule_cache(cache_path)
+    
+    parsed = {
+        path: cached_molecules[path] for path in paths
+        if cached_manifest.get(path) == manifest[path] and path in cached_molecules
+    }
+    stale_paths = [path for path in paths if path not in parsed]
+    stale_names = [names[path] for path in stale_paths]
+    stale_mtimes = [manifest[path][0] for path in stale_paths]
+    stale_sizes = [manifest[path][1] for path in stale_paths]
+    
+    if parsed:
+        print(f"Loaded {len(parsed)} files from cache, parsing {len(stale_paths)} files.")
+    
+    # Parsing is CPU-bound and independent per file, so spread it across processes
+    results = None
+    if len(stale_paths) >= PARALLEL_PARSE_MIN_FILES:
+        try:
+            with concurrent.futures.ProcessPoolExecutor() as ex:
+                results = list(ex.map(parse_mol2_file, stale_paths, stale_names, stale_mtimes, stale_sizes, chunksize=64))
+        except (OSError, concurrent.futures.process.BrokenProcessPool) as e:
+            # No working process pool (e.g. no /dev/shm in a container); parse serially instead
+            print(f"Parallel parsing failed ({str(e)}), parsing serially.")
+    
+    if results is None:
+        results = [
+            parse_mol2_file(path, name, mtime, size)
+            for path, name, mtime, size in zip(stale_paths, stale_names, stale_mtimes, stale_sizes)
+        ]
     
-    for file_name in mol2_files:
-        file_path = os.path.join(db_path, file_name)
-        molecule_data = parse_mol2_file(file_path)
+    # Files that failed to parse are stored as None so they are not reparsed until they change
+    for path, molecule_data in zip(stale_paths, results):
+        parsed[path] = molecule_data
+    
+    if cache_path and stale_paths:
+        save_molecule_cache(cache_path, manifest, parsed)
+    
+    for path in paths:
+        molecule_data = parsed.get(path)
         if molecule_data and molecule_data['atom_count'] >= min_atoms:
             molecules.append(molecule_data)
     
@@ -123,7 +287,7 @@ def select_representative_molecules(molecules, num_to_select=10, min_atoms=5):
     for molecule in molecules:
         atom_count = molecule['atom_count']
         if atom_count not in bins:
-            bins[atom_count] = []
+            bins[atom_count] = deque()
         bins[atom_count].append(molecule)
     
     # Select one molecule from each bin, prioritizing bins with different atom counts
@@ -138,13 +302,9 @@ def select_representative_molecules(molecules, num_to_select=10, min_atoms=5):
     # Try to select num_to_select molecules
     while len(selected_molecules) < num_to_select and atom_counts:
         # Start from the smallest molecule and move upward
-        for atom_count in atom_counts[:]:
-            if not bins[atom_count]:  # If this bin is empty, remove it
-                atom_counts.remove(atom_count)
-                continue
-                
+        for atom_count in atom_counts:
             # Get a molecule from this bin
-            molecule = bins[atom_count].pop(0)
+            molecule = bins[atom_count].popleft()
             file_path = molecule['file_path']
             
             if file_path not in used_file_paths:
@@ -155,15 +315,24 @@ def select_representative_molecules(molecules, num_to_select=10, min_atoms=5):
                 if len(selected_molecules) >= num_to_select:
                     break
         
-        # If we've gone through all atom counts and still need more molecules,
-        # break to avoid an infinite loop
-        if not any(bins.values()):
-            break
+        # Only keep the bins that still have molecules for the next pass; once all
+        # are empty the loop ends
+        atom_counts = [count for count in atom_counts if bins[count]]
     
     print(f"Selected {len(selected_molecules)} representative molecules, starting with {min_atoms} atoms.")
     return selected_molecules
 
-def find_similar_molecules(target, all_molecules, similarity_threshold, exclude=None):
+def _indices_within(atom_counts, target_atom_count, max_diff):
+    """
+    Return the range of indices whose atom count differs from the target by at most max_diff.
+    atom_counts must be sorted in ascending order.
+    """
+    lo = bisect.bisect_left(atom_counts, target_atom_count - max_diff)
+    hi = bisect.bisect_right(atom_counts, target_atom_count + max_diff)
+    return range(lo, hi)
+
+def find_similar_molecules(target, all_molecules, similarity_threshold, exclude=None,
+                           atom_counts=None, file_paths=None):
     """
     Find molecules similar to the target molecule based on atom count.
     Returns a list of similar molecules.
@@ -172,59 +341,59 @@ def find_similar_molecules(target, all_molecules, similarity_threshold, exclude=
         target: The target molecule dictionary
         all_molecules: List of all molecule dictionaries
         similarity_threshold: Maximum percentage difference in atom count
-        exclude: List of file paths to exclude
+        exclude: Set of file paths to exclude
+        atom_counts: Optional list of atom counts parallel to all_molecules
+        file_paths: Optional list of file paths parallel to all_molecules
+    
+    When atom_counts and file_paths are given, all_molecules must be sorted by atom
+    count; otherwise they are built here in the caller's order. Molecules at the same
+    distance from the target are returned in the order they appear in all_molecules.
     """
     if exclude is None:
-        exclude = []
+        exclude = set()
     
     target_atom_count = target['atom_count']
+    target_path = target['file_path']
     max_diff = target_atom_count * similarity_threshold
     
-    # Filter molecules within the similarity threshold
+    if atom_counts is None or file_paths is None:
+        # Unsorted input: scan for the window so ties keep the caller's order
+        atom_counts = [m['atom_count'] for m in all_molecules]
+        file_paths = [m['file_path'] for m in all_molecules]
+        window = [i for i in range(len(atom_counts)) if abs(atom_counts[i] - target_atom_count) <= max_diff]
+    else:
+        window = _indices_within(atom_counts, target_atom_count, max_diff)
+    
+    # Molecules within the similarity threshold are the closest ones, so look there first
     similar_candidates = [
-        mol for mol in all_molecules
-        if (abs(mol['atom_count'] - target_atom_count) <= max_diff) and
-           (mol['file_path'] != target['file_path']) and
-           (mol['file_path'] not in exclude)
+        i for i in window
+        if file_paths[i] != target_path and file_paths[i] not in exclude
     ]
     
-    # If not enough similar molecules, gradually increase the threshold
+    # If not enough similar molecules, take the closest ones by atom count over all
+    # molecules; widening the threshold step by step would end with the same choice
     if len(similar_candidates) < 2:
-        threshold_multiplier = 1.5
-        while len(similar_candidates) < 2 and threshold_multiplier <= 5:
-            new_max_diff = target_atom_count * similarity_threshold * threshold_multiplier
-            similar_candidates = [
-                mol for mol in all_molecules
-                if (abs(mol['atom_count'] - target_atom_count) <= new_max_diff) and
-                   (mol['file_path'] != target['file_path']) and
-                   (mol['file_path'] not in exclude)
-            ]
-            threshold_multiplier += 0.5
-    
-    # If still not enough, just take the closest ones by atom count
-    if len(similar_candidates) < 2:
-        candidates = [
-            mol for mol in all_molecules
-            if (mol['file_path'] != target['file_path']) and
-               (mol['file_path'] not in exclude)
+        similar_candidates = [
+            i for i in range(len(file_paths))
+            if file_paths[i] != target_path and file_paths[i] not in exclude
         ]
-        candidates.sort(key=lambda x: abs(x['atom_count'] - target_atom_count))
-        similar_candidates = candidates[:2]
     
-    # Select the most similar molecules
-    similar_candidates.sort(key=lambda x: abs(x['atom_count'] - target_atom_count))
-    return similar_candidates[:2]
+    # Select the most similar molecules, only looking up the chosen dictionaries
+    similar_candidates.sort(key=lambda i: abs(atom_counts[i] - target_atom_count))
+    return [all_molecules[i] for i in similar_candidates[:2]]
 
 def prepare_game_dataset(molecules, min_atoms=5):
     """
     Prepare the dataset for the game, including similar molecules for each target.
-    Returns a list of game levels, each with a target and similar molecules.
+    Returns a tuple (game_levels, molecules_to_copy): the list of game levels, each
+    with a target and similar molecules, and the molecule dictionaries used by them.
     
     Args:
         molecules: List of all molecule dictionaries
         min_atoms: Minimum number of atoms required in any selected molecule
     """
     game_levels = []
+    molecules_to_copy = []  # Molecules used as a target or similar option
     used_molecules_paths = set()  # Store only file paths
     
     # Filter molecules by minimum atom count
@@ -232,6 +401,8 @@ def prepare_game_dataset(molecules, min_atoms=5):
     
     # Sort molecules by atom count for progressive difficulty
     sorted_molecules = sorted(molecules, key=lambda x: x['atom_count'])
+    sorted_atom_counts = [m['atom_count'] for m in sorted_molecules]
+    sorted_file_paths = [m['file_path'] for m in sorted_molecules]
     
     for target_mol in sorted_molecules:
         # Skip if this molecule is already used in another level
@@ -241,9 +412,11 @@ def prepare_game_dataset(molecules, min_atoms=5):
         # Find similar molecules that haven't been used yet
         similar_mols = find_similar_molecules(
             target_mol,
-            molecules,
+            sorted_molecules,
             SIMILARITY_THRESHOLD,
-            exclude=list(used_molecules_paths)  # Pass list of file paths
+            exclude=used_molecules_paths,
+            atom_counts=sorted_atom_counts,
+            file_paths=sorted_file_paths
         )
         
         # If we couldn't find enough similar molecules, skip this target
@@ -272,12 +445,46 @@ def prepare_game_dataset(molecules, min_atoms=5):
         }
         
         game_levels.append(level)
+        molecules_to_copy.append(target_mol)
+        molecules_to_copy.extend(similar_mols)
         
         # If we have enough levels, stop
         if len(game_levels) >= NUM_MOLECULES:
             break
     
-    return game_levels
+    return game_levels, molecules_to_copy
+
+# Errors from os.copy_file_range that mean "use a regular copy instead"
+_COPY_FILE_RANGE_UNSUPPORTED = {
+    errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF, errno.EPERM
+}
+
+def copy_molecule_file(source_path, target_file):
+    """
+    Copy a single molecule file.
+    Uses os.copy_file_range where available so the kernel copies (or reflinks) the
+    data without passing it through user space, falling back to shutil.copyfile.
+    """
+    if os.path.exists(target_file) and os.path.samefile(source_path, target_file):
+        raise shutil.SameFileError(f"'{source_path}' and '{target_file}' are the same file")
+    
+    if hasattr(os, 'copy_file_range'):
+        with open(source_path, 'rb') as src, open(target_file, 'wb') as dst:
+            remaining = os.fstat(src.fileno()).st_size
+            try:
+                while remaining > 0:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining)
+                    if copied == 0:
+                        break  # Some filesystems report 0 without copying; use shutil instead
+                    remaining -= copied
+            except OSError as e:
+                # Not supported for these files, e.g. across filesystems on older kernels
+                if e.errno not in _COPY_FILE_RANGE_UNSUPPORTED:
+                    raise
+        if remaining == 0:
+            return
+    
+    shutil.copyfile(source_path, target_file)
 
 def copy_selected_molecules(selected_molecules, target_path):
     """
@@ -286,11 +493,12 @@ def copy_selected_molecules(selected_molecules, target_path):
     if not os.path.exists(target_path):
         os.makedirs(target_path)
     
-    for mol in selected_molecules:
-        source_path = mol['file_path']
-        target_file = os.path.join(target_path, os.path.basename(source_path))
-        shutil.copy(source_path, target_file)
-        print(f"Copied: {os.path.basename(source_path)}")
+    source_paths = [mol['file_path'] for mol in selected_molecules]
+    target_files = [os.path.join(target_path, mol['file_name']) for mol in selected_molecules]
+    
+    # Copying is I/O-bound, so overlap the copies with a thread pool
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(32, len(source_paths)))) as ex:
+        list(ex.map(copy_molecule_file, source_paths, target_files))
     
     print(f"\nCopied {len(selected_molecules)} molecule files to '{target_path}'")
 
@@ -326,39 +534,25 @@ def main():
     
     # Prepare game dataset with similar molecules
     print("\nPreparing game dataset with similar molecules...")
-    game_levels = prepare_game_dataset(all_molecules, min_atoms=min_atoms)
+    game_levels, molecules_to_copy = prepare_game_dataset(all_molecules, min_atoms=min_atoms)
     print(f"Created {len(game_levels)} game levels.")
     
-    # Collect all molecules that need to be copied
-    molecules_to_copy_paths = set()  # Set of file paths to copy
-    for level in game_levels:
-        target_file = level['target']['file']
-        for mol in all_molecules:
-            if os.path.basename(mol['file_path']) == target_file:
-                molecules_to_copy_paths.add(mol['file_path'])
-                break
-        
-        for similar in level['similar']:
-            similar_file = similar['file']
-            for mol in all_molecules:
-                if os.path.basename(mol['file_path']) == similar_file:
-                    molecules_to_copy_paths.add(mol['file_path'])
-                    break
-    
-    # Convert back to list of molecule objects for copying
-    molecules_to_copy = [mol for mol in all_molecules if mol['file_path'] in molecules_to_copy_paths]
-    
     # Write dataset to JSON file
     try:
         json_dir = os.path.dirname(JSON_OUTPUT_PATH)
         if not os.path.exists(json_dir):
             os.makedirs(json_dir)
             
-        with open(JSON_OUTPUT_PATH, 'w') as f:
-            json.dump({
-                'levels': game_levels,
-                'total': len(game_levels)
-            }, f, indent=2)
+        dataset = {
+            'levels': game_levels,
+            'total': len(game_levels)
+        }
+        if orjson is not None:
+            with open(JSON_OUTPUT_PATH, 'wb') as f:
+                f.write(orjson.dumps(dataset, option=orjson.OPT_INDENT_2))
+        else:
+            with open(JSON_OUTPUT_PATH, 'w') as f:
+                json.dump(dataset, f, indent=2)
         print(f"\nSaved game dataset to '{JSON_OUTPUT_PATH}'")
     except Exception as e:
         print(f"Error saving JSON file: {str(e)}")